@@ -1,11 +1,14 @@
 import sys
 import os
+import re
+import shutil
 import logging
 import uuid
 import time
 from joblib import Parallel
 from joblib import delayed as dlyed
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from dask.distributed import Client
 from dask import delayed
 from dask.distributed import progress
@@ -15,9 +18,15 @@ import ngram
 
 import pandas as pd
 import json
+from functools import reduce
+import heapq
+from itertools import groupby
+from operator import itemgetter
 from glob import glob
 from tqdm import tqdm
 
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
 logging.basicConfig(format='%(levelname)s %(asctime)s - %(message)s', level=logging.INFO)
 
 def load_config():
@@ -37,6 +46,13 @@ def load_config():
         sys.exit(1)
         raise
 
+def read_file(path):
+    """
+    Lit et retourne le contenu d'un fichier texte.
+    """
+    with open(path, encoding="utf-8", mode="r") as file:
+        return file.read()
+
 def load_data(parameters):
     """
     Fonction permettant de charger les données en fonction des paramètres donnés dans le fichier de configuration.
@@ -57,7 +73,9 @@ def load_data(parameters):
 
         if data_type == "files":
             files_paths = glob(path+"*"+parameters["file_extension"])
-            data = [open(file, encoding="utf-8", mode="r").read() for file in tqdm(files_paths)]
+            # Lecture multi-threadée : le GIL est relâché pendant les lectures disque
+            with ThreadPoolExecutor(max_workers=32) as executor:
+                data = list(tqdm(executor.map(read_file, files_paths), total=len(files_paths)))
 
         logging.info("Loaded.")
         return data
@@ -103,24 +121,93 @@ def load_or_create_vocabulary(data, name):
         sys.exit(1)
         raise
 
-def train_ngram(n, text, vocab):
+def save_temp_shards(gram, nb_shards):
+    """
+    Enregistre un Ngram dans nb_shards fichiers temporaires data/temp/{n}/{uuid}.shard{p}.tmp, un par shard de clés.
+    """
+    unique_id = uuid.uuid4()
+    for p, gram_shard in enumerate(gram.shard(nb_shards)):
+        gram_shard.save_sorted(f"data/temp/{gram.n}/{unique_id}.shard{p}.tmp")
+
+def list_temp_shards(temp_path, nb_shards):
+    """
+    Liste en un seul parcours du dossier les fichiers temporaires, regroupés par shard.
+
+    :param temp_path: Dossier des fichiers temporaires
+    :param nb_shards: Nombre de shards
+
+    :return: la liste des chemins de chaque shard.
+    """
+    shards = [[] for _ in range(nb_shards)]
+    with os.scandir(temp_path) as entries:
+        for entry in entries:
+            if entry.name.endswith(".tmp"):
+                p = int(entry.name[:-len(".tmp")].rsplit(".shard", 1)[1])
+                shards[p].append(entry.path)
+    return shards
+
+def build_ngram_batch(n, texts):
+    """
+    Entraîne un seul Ngram sur un lot de documents et le retourne.
+
+    :param n: Taille du n-gram
+    :param texts: Liste des documents du lot, déjà convertis en ids (Vocabulary.chain_to_id_array)
+
+    :return: le Ngram partiel du lot.
+    """
     gram = ngram.Ngram(n)
-    text = vocab.chain_to_ids(text)
-    gram.train(text)
+    # Un seul comptage NumPy par paquet d'environ 1M ids, pour borner la mémoire des fenêtres
+    for chunk in chunk_by_size(texts, 1_000_000):
+        gram.train_batch(chunk)
+    return gram
 
-    unique_id = uuid.uuid4()
-    gram.save("data/temp/"+str(unique_id)+".tmp")
+def train_ngram_batch(n, texts, nb_shards=1):
+    """
+    Entraîne un seul Ngram sur un lot de documents et l'enregistre dans un unique jeu de fichiers temporaires.
+
+    :param n: Taille du n-gram
+    :param texts: Liste des documents du lot, déjà convertis en ids (Vocabulary.chain_to_id_array)
+    :param nb_shards: Nombre de shards de clés à écrire
+    """
+    save_temp_shards(build_ngram_batch(n, texts), nb_shards)
+
+def chunk_by_size(data, chunk_size):
+    """
+    Regroupe les documents en paquets successifs d'environ chunk_size éléments.
+
+    :param data: Liste des documents (chaînes ou tableaux d'ids)
+    :param chunk_size: Taille cible d'un paquet, en caractères ou en ids
+
+    :return: la liste des paquets de documents.
+    """
+    chunks = []
+    chunk = []
+    size = 0
+    for text in data:
+        chunk.append(text)
+        size += len(text)
+        if size >= chunk_size:
+            chunks.append(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
 
 def merge_grams(gram1, gram2):
+    """
+    Fusionne les fréquences de gram2 dans gram1 et retourne gram1.
+
+    Les séquences absentes de gram1 reprennent directement le dictionnaire de gram2, qui ne doit plus être utilisé ensuite.
+    """
+    chain_frequency = gram1.chain_frequency
     for key, value in gram2.chain_frequency.items():
-        if key not in gram1.chain_frequency:
-            gram1.chain_frequency[key] = value
+        frequencies = chain_frequency.get(key)
+        if frequencies is None:
+            chain_frequency[key] = value
         else:
             for sub_key, sub_value in value.items():
-                if sub_key not in gram1.chain_frequency[key]:
-                    gram1.chain_frequency[key][sub_key] = sub_value
-                else:
-                    gram1.chain_frequency[key][sub_key] += sub_value
+                frequencies[sub_key] = frequencies.get(sub_key, 0) + sub_value
     return gram1
 
 def merge_models_incrementally(models_to_merge):
@@ -142,11 +229,28 @@ def merge_models_incrementally(models_to_merge):
 
     return models_to_merge[0]
 
+def stream_merge_grams(models_paths, n):
+    """
+    Fusionne des fichiers triés (Ngram.save_sorted) par un k-way merge : seul un enregistrement par fichier est en mémoire.
+
+    :param models_paths: Chemins des fichiers temporaires à fusionner
+    :param n: Taille du n-gram
+
+    :return: le modèle fusionné.
+    """
+    gram = ngram.Ngram(n)
+    chain_frequency = gram.chain_frequency
+    # Les enregistrements arrivent triés : chaque séquence est complétée puis insérée une seule fois
+    for sequence, records in groupby(heapq.merge(*[ngram.read_sorted(path) for path in models_paths]), key=itemgetter(0)):
+        frequencies = {}
+        for _, next, frequency in records:
+            frequencies[next] = frequencies.get(next, 0) + frequency
+        chain_frequency[sequence] = frequencies
+    return gram
+
 def preprocessing(text):
-    text = text.strip()
-    text = text.replace("\n", " ")
-    " ".join([t for t in text.split()])
-    return text
+    # Une seule passe : espaces et retours à la ligne multiples réduits à un espace
+    return WHITESPACE_PATTERN.sub(" ", text).strip()
 
 
 def main():
@@ -168,9 +272,21 @@ def main():
     ngram_min = config["ngram_range_min"]
     ngram_max = config["ngram_range_max"]
 
+    # Documents les plus longs en premier pour équilibrer la charge entre les workers
+    data = sorted(data, key=len, reverse=True)
+
+    # Conversion en ids une seule fois, réutilisée pour toutes les valeurs de n
+    logging.info("Encoding documents...")
+    # Tableaux int32 plutôt que chaînes : bien plus compacts à sérialiser vers les workers
+    encoded = [vocab.chain_to_id_array(str(text)) for text in tqdm(data)]
+    del data
+
+    nb_shards = config["nb_shards"]
+
     logging.info(f"Training Ngram range({ngram_min},{ngram_max})")
     total_start_time = time.time()
 
+    client = None
     if config["dask_distributed"]:
         logging.info("Starting Dask session...")
         local_scheduler_address = config["local_scheduler_address"]
@@ -178,84 +294,86 @@ def main():
         workers = client.scheduler_info()['workers']
         nthreads_total = sum(worker['nthreads'] for worker in workers.values())
         logging.info(f"Active Workers: {len(workers)}, Total Threads: {nthreads_total}")
-        logging.info("Sending Vocabulary to workers...")
-        distributed_vocab = client.scatter(vocab, broadcast=True)
 
-    for n in range(ngram_min, ngram_max+1):
-        [os.remove(path) for path in glob("data/temp/*.tmp")]
-        start_time = time.time()
+    # Une seule session Dask, réutilisée pour toutes les valeurs de n
+    try:
+        for n in range(ngram_min, ngram_max+1):
+            output_path = f"data/ngram/{name}/{n}"
+            os.makedirs(output_path, exist_ok=True)
+            [os.remove(path) for path in glob(f"{output_path}/*.ngram")]
+            start_time = time.time()
+
+            if not config["dask_distributed"]:
+                logging.info(f"Starting Training Ngram, n={n} on local CPU")
+
+                # Entraînement et fusion dans le même passage : les Ngram partiels restent en mémoire, sans fichiers temporaires
+                if config["parallelize"]:
+                    logging.info(f"Parallel Processes: {multiprocessing.cpu_count()} ")
+                    # Un lot par tâche plutôt qu'un document par tâche, pour limiter le coût de sérialisation
+                    nb_batches = 4*multiprocessing.cpu_count()
+                    batches = [encoded[i::nb_batches] for i in range(nb_batches)]
+                    partial_grams = Parallel(n_jobs=-1, batch_size='auto', prefer='processes', return_as='generator')(dlyed(build_ngram_batch)(n, batch) for batch in batches)
+                    gram_final = reduce(merge_grams, partial_grams, ngram.Ngram(n))
 
-        # Training with Dask
-        if not config["dask_distributed"]:
-            logging.info(f"Starting Training Ngram, n={n} on local CPU")
+                else:
+                    # Training on single CPU
+                    gram_final = build_ngram_batch(n, tqdm(encoded))
 
-            # Training parallelized
-            if config["parallelize"]:
-                logging.info(f"Parallel Processes: {multiprocessing.cpu_count()} ")
-                Parallel(n_jobs=-1)(dlyed(train_ngram)(n, str(text), vocab) for text in data)
+                end_time = time.time()
+                logging.info(f"Training and merging finished in {round(end_time-start_time,2)}s")
 
             else:
-                # Training on single CPU
-                [train_ngram(n, str(text), vocab) for text in tqdm(data)]
-
-        else:
-            # Commencer la session Dask
-            scheduler_address = config["scheduler_address"]
-            logging.info(f"Starting Training, n={n} on Dask Cluster.")
-            logging.info(f"Scheduler IP: {scheduler_address}")
-
-            client = Client(local_scheduler_address)
-            workers = client.scheduler_info()['workers']
-            nthreads_total = sum(worker['nthreads'] for worker in workers.values())
-
-            logging.info(f"Active Workers: {len(workers)}, Total Threads: {nthreads_total}")
+                # Un dossier temporaire par n, supprimé d'un bloc
+                temp_path = f"data/temp/{n}"
+                shutil.rmtree(temp_path, ignore_errors=True)
+                os.makedirs(temp_path)
 
-            results = [delayed(train_ngram)(text, distributed_vocab) for text in data]
+                # Commencer la session Dask
+                scheduler_address = config["scheduler_address"]
+                logging.info(f"Starting Training, n={n} on Dask Cluster.")
+                logging.info(f"Scheduler IP: {scheduler_address}")
 
-            futures = client.compute(results)
+                # Une tâche par paquet d'environ 1 Mo d'ids int32 plutôt qu'une tâche par document
+                chunks = chunk_by_size(encoded, 250_000)
+                results = [delayed(train_ngram_batch)(n, chunk, nb_shards) for chunk in chunks]
 
-            progress(futures)
+                futures = client.compute(results)
 
-        end_time = time.time()
-        logging.info(f"Training finished in {round(end_time-start_time,2)}s")
+                progress(futures)
 
-        logging.info("Libération de la mémoire...")
-        del vocab
-        del data
-        logging.info("Mémoire libérée.")
+                end_time = time.time()
+                logging.info(f"Training finished in {round(end_time-start_time,2)}s")
 
-        # Prepare Mergine
-        output_path = f"data/ngram/{name}/{n}"
-        os.makedirs(output_path, exist_ok=True)
-        [os.remove(path) for path in glob(f"{output_path}/*.ngram")]
+                shards_to_merge = list_temp_shards(temp_path, nb_shards)
+                logging.info(f"Merging {sum(len(models_to_merge) for models_to_merge in shards_to_merge)} files in {nb_shards} shards...")
+                start_time = time.time()
 
-        models_to_merge = glob("data/temp/*.tmp")
-        logging.info(f"Merging {len(models_to_merge)} files...")
-        start_time = time.time()
+                # Les shards portent sur des clés disjointes : chacun est fusionné en flux (k-way merge) par une tâche Dask indépendante
+                grams_shards = client.gather(client.compute([delayed(stream_merge_grams)(models_to_merge, n) for models_to_merge in shards_to_merge]))
 
-        gram_final = ngram.Ngram()
-        for model_path in tqdm(models_to_merge):
-            sub_gram = ngram.Ngram()
-            sub_gram.load(model_path)
-            gram_final = merge_grams(gram_final, sub_gram)
-            os.remove(model_path)
+                gram_final = ngram.Ngram(n)
+                for gram_shard in grams_shards:
+                    gram_final.chain_frequency.update(gram_shard.chain_frequency)
 
-        end_time = time.time()
-        logging.info(f"Merging finished in {round(end_time-start_time,2)}s")
+                # Remove temp files
+                shutil.rmtree(temp_path)
 
-        logging.info(f"Saving model...")
-        gram_final.save(output_path+f"/model_{n}.ngram")
-        logging.info(f"Saved in {output_path}.")
+                end_time = time.time()
+                logging.info(f"Merging finished in {round(end_time-start_time,2)}s")
 
-        logging.info("Libération de la mémoire...")
-        del gram_final
-        logging.info("Mémoire libérée.")
+            logging.info(f"Saving model...")
+            gram_final.save(output_path+f"/model_{n}.ngram")
+            logging.info(f"Saved in {output_path}.")
 
-        # Remove temp files
-        [os.remove(path) for path in glob("data/temp/*.tmp")]
+            logging.info("Libération de la mémoire...")
+            del gram_final
+            logging.info("Mémoire libérée.")
 
-        total_end_time = time.time()
-        logging.info(f"All Procedure finished in {round(total_end_time-total_start_time,2)}s")
+            total_end_time = time.time()
+            logging.info(f"All Procedure finished in {round(total_end_time-total_start_time,2)}s")
+    finally:
+        if client is not None:
+            client.close()
 
 
 if __name__ == '__main__':
@@ -1 +1,2 @@
 from .ngram import Ngram
+from .ngram import read_sorted
@@ -1,8 +1,48 @@
+import os
 import pickle
+import struct
 import random
+import numpy as np
 import copy
 import dask.delayed
 
+# En-tête des fichiers triés : valeur de n
+HEADER = struct.Struct('<I')
+
+# Fréquence maximale stockée dans un fichier trié (uint32, addition saturante)
+MAX_FREQUENCY = 2**32 - 1
+
+def record_struct(n):
+    # Un enregistrement : n ids de la séquence, id du mot suivant, fréquence (uint32)
+    return struct.Struct('<' + 'I'*n + 'II')
+
+def record_dtype(n):
+    # Même disposition que record_struct, pour lire les fichiers sans copie avec NumPy
+    return np.dtype([('sequence', '<u4', (n,)), ('next', '<u4'), ('frequency', '<u4')])
+
+def read_sorted(filepath, chunk_records=1024):
+    """
+    Lit un fichier écrit par Ngram.save_sorted et produit les triplets (séquence, mot suivant, fréquence) dans l'ordre.
+
+    Le fichier est projeté en mémoire (np.memmap) et seuls chunk_records enregistrements à la fois sont convertis en
+    objets Python : un k-way merge sur N fichiers garde au plus N paquets de chunk_records triplets en mémoire.
+    """
+    with open(filepath, 'rb') as load_file:
+        n = HEADER.unpack(load_file.read(HEADER.size))[0]
+    dtype = record_dtype(n)
+    nb_records = (os.path.getsize(filepath) - HEADER.size) // dtype.itemsize
+    if nb_records == 0:
+        return
+    records = np.memmap(filepath, dtype=dtype, mode='r', offset=HEADER.size, shape=(nb_records,))
+    for start in range(0, nb_records, chunk_records):
+        chunk = records[start:start+chunk_records]
+        sequences = chunk['sequence'].tolist()
+        if n > 1:
+            sequences = map(tuple, sequences)
+        else:
+            sequences = (sequence[0] for sequence in sequences)
+        yield from zip(sequences, chunk['next'].tolist(), chunk['frequency'].tolist())
+
 class Ngram():
     def __init__(self, n=1):
         self.n = n
@@ -10,21 +50,49 @@ class Ngram():
         self.chain = {}
 
     def train(self, text, separator = " "):
-        words = text.split(separator)
-        for i in range(len(words)-self.n):
-            if self.n>1:
-                sequence = tuple([int(words[i+y]) for y in range(self.n)])
-            else:
-                sequence = int(words[i])
-            get = self.chain_frequency.get(sequence,0)
-            next = int(words[i+self.n])
-            if get == 0:
-                self.chain_frequency[sequence] = {}
-                self.chain_frequency[sequence][next] = 1
-            elif get.get(int(words[i+self.n]),0) == 0:
-                self.chain_frequency[sequence][next] = 1
+        self.train_batch([text], separator)
+
+    def train_batch(self, texts, separator = " "):
+        # texts : chaînes d'ids séparés par separator, ou tableaux d'ids (Vocabulary.chain_to_id_array)
+        documents = [np.array(text.split(separator) if text else [], dtype=np.int64) if isinstance(text, str) else text for text in texts]
+        if not documents:
+            return
+        words = np.concatenate(documents).astype(np.int64, copy=False)
+        if len(words) <= self.n:
+            return
+        # Fenêtres de n+1 ids (séquence + mot suivant) de tout le lot, sans celles à cheval sur deux documents
+        document_index = np.repeat(np.arange(len(documents)), [len(document) for document in documents])
+        windows = np.lib.stride_tricks.sliding_window_view(words, self.n+1)[document_index[:-self.n] == document_index[self.n:]]
+        if len(windows) == 0:
+            return
+        # Empaquetage colonne par colonne : la clé d'un préfixe est le rang dense de (clé du préfixe précédent, id),
+        # elle reste donc inférieure au nombre de fenêtres et ne peut pas déborder
+        base = int(words.max())+1
+        keys = windows[:, 0]
+        for column in range(1, self.n):
+            keys = np.unique(keys*base + windows[:, column], return_inverse=True)[1]
+        _, first, counts = np.unique(keys*base + windows[:, self.n], return_index=True, return_counts=True)
+        # Les fenêtres distinctes sont triées par préfixe : un seul dictionnaire construit par séquence
+        prefixes = keys[first]
+        starts = np.flatnonzero(np.concatenate(([True], prefixes[1:] != prefixes[:-1])))
+        ends = np.append(starts[1:], len(first)).tolist()
+        if self.n > 1:
+            # Tuples construits colonne par colonne (listes 1-D), bien plus rapide qu'un tolist() 2-D
+            sequences = zip(*windows[first[starts], :self.n].T.tolist())
+        else:
+            sequences = windows[first[starts], 0].tolist()
+        nexts = windows[first, self.n].tolist()
+        counts = counts.tolist()
+        for sequence, start, end in zip(sequences, starts.tolist(), ends):
+            frequencies = self.chain_frequency.get(sequence)
+            if frequencies is None:
+                if end - start == 1:
+                    self.chain_frequency[sequence] = {nexts[start]: counts[start]}
+                else:
+                    self.chain_frequency[sequence] = dict(zip(nexts[start:end], counts[start:end]))
             else:
-                self.chain_frequency[sequence][next] += 1
+                for next, count in zip(nexts[start:end], counts[start:end]):
+                    frequencies[next] = frequencies.get(next, 0) + count
 
     def normalize(self):
         self.chain = copy.deepcopy(self.chain_frequency)
@@ -33,9 +101,25 @@ class Ngram():
             for k, v in value.items():
                 self.chain[key][k] = v / sum_frequency
 
+    def shard(self, nb_shards):
+        # Répartit les séquences en nb_shards modèles disjoints selon hash(séquence) % nb_shards
+        shards = [Ngram(self.n) for _ in range(nb_shards)]
+        for key, value in self.chain_frequency.items():
+            shards[hash(key) % nb_shards].chain_frequency[key] = value
+        return shards
+
     def save(self, filepath):
         with open(filepath, 'wb') as save_file:
-            pickle.dump(self.__dict__, save_file)
+            pickle.dump(self.__dict__, save_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def save_sorted(self, filepath):
+        record = record_struct(self.n)
+        with open(filepath, 'wb') as save_file:
+            save_file.write(HEADER.pack(self.n))
+            for key in sorted(self.chain_frequency):
+                sequence = key if self.n > 1 else (key,)
+                frequencies = self.chain_frequency[key]
+                save_file.write(b"".join(record.pack(*sequence, next, min(frequencies[next], MAX_FREQUENCY)) for next in sorted(frequencies)))
 
     def load(self, filepath):
         try:
@@ -1,4 +1,5 @@
 import pickle
+import numpy as np
 
 class Vocabulary:
     def __init__(self):
@@ -50,6 +51,12 @@ class Vocabulary:
         result = " ".join([str(self.word_to_id(t)) for t in text.split()])
         return result
 
+    def chain_to_id_array(self, text):
+        """
+        Retourne une chaine de caractères convertie en tableau d'ids (int32)
+        """
+        return np.fromiter((self.word_to_id(t) for t in text.split()), dtype=np.int32)
+
     def ids_to_chain(self, text):
         """
         Reconstitue une chaine de caractère à partir des ids